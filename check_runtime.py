@@ -1,174 +1,331 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import collections
+import concurrent.futures
 import ctypes
 import ctypes.util
-import pkg_resources
+import functools
+import importlib.util
 import os
+import sys
 
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    try:
+        import importlib_metadata
+    except ImportError:
+        # Fall back to pkg_resources (imported on demand as it is slow).
+        importlib_metadata = None
+
+
+# find_library may spawn external commands (e.g., ldconfig or gcc), so
+# remember the results including libraries not found.
+find_library = functools.lru_cache(maxsize=None)(ctypes.util.find_library)
 
+
+@functools.lru_cache(maxsize=None)
 def get_cdll(name):
-    libname = ctypes.util.find_library(name)
+    libname = find_library(name)
     if libname is None:
         return None
+    # Reuse the library if it is already loaded (e.g., by CuPy) instead of
+    # loading it again.
+    rtld_noload = getattr(os, 'RTLD_NOLOAD', None)
+    if rtld_noload is not None:
+        try:
+            return ctypes.CDLL(libname, mode=rtld_noload | os.RTLD_NOW)
+        except OSError:
+            pass
     try:
         return ctypes.CDLL(libname)
     except OSError:
         return None
 
 
-def get_cdll_path(func):
-    libdl = get_cdll('dl')
-    if libdl is None or not hasattr(libdl, 'dladdr'):
-        return 'N/A'
+class Dl_info(ctypes.Structure):
+    __slots__ = ()
+    _fields_ = (
+        ('dli_fname', ctypes.c_char_p),
+        ('dli_fbase', ctypes.c_void_p),
+        ('dli_sname', ctypes.c_char_p),
+        ('dli_saddr', ctypes.c_void_p),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_dladdr():
+    # Set up the prototype only once, on first use.
+    dladdr = getattr(get_cdll('dl'), 'dladdr', None)
+    if dladdr is not None:
+        dladdr.argtypes = (ctypes.c_void_p, ctypes.POINTER(Dl_info))
+        dladdr.restype = ctypes.c_int
+    return dladdr
 
-    class Dl_info(ctypes.Structure):
-        _fields_ = (
-            ('dli_fname', ctypes.c_char_p),
-            ('dli_fbase', ctypes.c_void_p),
-            ('dli_sname', ctypes.c_char_p),
-            ('dli_saddr', ctypes.c_void_p),
-        )
 
-    libdl.dladdr.argtypes = (ctypes.c_void_p, ctypes.POINTER(Dl_info))
+def get_cdll_path(func):
+    dladdr = get_dladdr()
+    if dladdr is None:
+        return 'N/A'
     info = Dl_info()
-    result = libdl.dladdr(func, ctypes.byref(info))
-    if result == 0:
+    result = dladdr(func, ctypes.byref(info))
+    if result == 0 or info.dli_fname is None:
         return '(error)'
     return info.dli_fname.decode()
 
 
+# CuPy package names and the range of CUDA versions ([lo, hi)) supported.
+CUPY_CUDA_RANGES = collections.OrderedDict([
+    ('cupy',        (7000, 10000)),
+    ('cupy-cuda80', (8000,  9000)),
+    ('cupy-cuda90', (9000,  9010)),
+    ('cupy-cuda91', (9010,  9020)),
+    ('cupy-cuda92', (9020,  9030)),
+])
+
+
+Package = collections.namedtuple(
+    'Package', ('project_name', 'version', 'location'))
+
+
 def get_package(name):
+    if importlib_metadata is None:
+        import pkg_resources
+        try:
+            dist = pkg_resources.get_distribution(name)
+        except pkg_resources.DistributionNotFound:
+            return None
+        return Package(dist.project_name, dist.version, dist.location)
+
     try:
-        return pkg_resources.get_distribution(name)
-    except pkg_resources.DistributionNotFound:
+        dist = importlib_metadata.distribution(name)
+    except importlib_metadata.PackageNotFoundError:
         return None
+    return Package(
+        dist.metadata['Name'], dist.version, str(dist.locate_file('')))
+
+
+# Output lines are buffered and written to stdout at each section header
+# and before steps that load native libraries, so that the report up to a
+# crash (e.g., segfault in a broken CUDA library) is still visible.
+_output = []
+
+
+def output(line=''):
+    _output.append(line + '\n')
+
+
+def flush_output():
+    sys.stdout.write(''.join(_output))
+    sys.stdout.flush()
+    del _output[:]
+
 
 def header(title):
-    print('')
-    print('=' * 40)
-    print(title)
-    print('=' * 40)
+    output('')
+    output('=' * 40)
+    output(title)
+    output('=' * 40)
+    flush_output()
+
+def format_report(title, status):
+    return '{:<22}: {}'.format(title, status)
+
 
 def report(title, status):
-    print('{:<22}: {}'.format(title, status))
+    output(format_report(title, status))
+
+
+def _report_pypkg(name, mod_future, pkg):
+    try:
+        mod = mod_future.result()
+        version = getattr(mod, '__version__', '(unknown version)')
+        import_msg = 'importing {} from {}'.format(version, mod.__path__)
+    except Exception as e:
+        import_msg = 'import failed with {}: {}'.format(
+            type(e).__name__, str(e))
+
+    if pkg is None:
+        status = 'not installed ({})'.format(import_msg)
+    else:
+        status = 'OK ({} version {} from {}) ({})'.format(
+            pkg.project_name, pkg.version, pkg.location, import_msg)
+
+    report(name, status)
+
+
+def _nvrtc_cache_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'chainer-doctor', 'nvrtc_ok')
 
 
-def main():
+def _nvrtc_test(cupy, key, use_cache=True):
+    # Compiling with NVRTC may take seconds; remember the last success for
+    # the given key, which identifies the CUDA/CuPy versions and libraries.
+    path = _nvrtc_cache_path()
+    if use_cache:
+        try:
+            with open(path) as f:
+                if f.read() == key:
+                    return 'OK (cached; use --no-cache to re-run)'
+        except (IOError, OSError):
+            pass
+
+    try:
+        cupy.cuda.compiler.compile_using_nvrtc('')
+    except Exception as e:
+        return 'failed ({})'.format(repr(e))
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(key)
+    except (IOError, OSError):
+        pass
+    return 'OK'
+
+
+def check(args, imports):
     ### Environment
     header('Environment')
     report('Current Directory', os.getcwd())
-    for (k, v) in os.environ.items():
-        if k.startswith('LD_') or k.startswith('DYLD_'):
-            report('${}'.format(k), v)
+    env_lines = sorted(
+        (k, v) for (k, v) in os.environ.items()
+        if k.startswith(('LD_', 'DYLD_')))
+    if env_lines:
+        output('\n'.join(
+            format_report('${}'.format(k), v) for (k, v) in env_lines))
 
     ### CuPy
     header('CuPy')
     cupy = None
-    (cupy_status, cudnn_status, nccl_status) = ('N/A', 'N/A', 'N/A')
     cudart_version = None
-    try:
-        import cupy
-        cupy_status = 'OK'
-        cudart_version = cupy.cuda.runtime.runtimeGetVersion()
+    # Avoid paying for the import machinery when CuPy is not installed.
+    if importlib.util.find_spec('cupy') is None:
+        cupy_status = 'failed (not installed)'
+    else:
+        try:
+            import cupy
+            cudart_version = cupy.cuda.runtime.runtimeGetVersion()
+            cupy_status = 'OK'
+        except Exception as e:
+            cupy_status = 'failed ({})'.format(repr(e))
+
+    report('Available', cupy_status)
+    if cupy is not None:
+        flush_output()
         try:
             import cupy.cuda.cudnn
             cudnn_status = 'OK'
         except Exception as e:
             cudnn_status = 'failed (optional) ({})'.format(repr(e))
+        report('Available (cuDNN)', cudnn_status)
+
+        flush_output()
         try:
             import cupy.cuda.nccl
             nccl_status = 'OK'
         except Exception as e:
             nccl_status = 'failed (optional) ({})'.format(repr(e))
-    except Exception as e:
-        cupy_status = 'failed ({})'.format(repr(e))
-
-    report('Available', cupy_status)
-    if cupy is not None:
-        report('Available (cuDNN)', cudnn_status)
         report('Available (NCCL)', nccl_status)
 
-        if hasattr(cupy, 'show_config'):
+        show_config = getattr(cupy, 'show_config', None)
+        if show_config is not None:
             report('show_config API', 'Available')
-            print('')
-            cupy.show_config()
-            print('')
+            output('')
+            # show_config writes to stdout directly.
+            flush_output()
+            show_config()
+            output('')
         else:
             report('show_config API',
                    'Not Available (optional) (requires v4.0.0+)')
 
+        flush_output()
         builtins = get_cdll('nvrtc-builtins')
         if builtins is None:
+            builtins_path = None
             report('NVRTC Builtins', 'Not Found')
         else:
             builtins_path = get_cdll_path(builtins.getArchBuiltins)
             report('NVRTC Builtins', 'Found ({})'.format(builtins_path))
 
-        try:
-            cupy.cuda.compiler.compile_using_nvrtc('')
-            cupy_compile = 'OK'
-        except Exception as e:
-            cupy_compile = 'failed ({})'.format(repr(e))
-        report('NVRTC Test', cupy_compile)
+        if args.compile_test:
+            flush_output()
+            key = repr((
+                cudart_version,
+                getattr(cupy, '__version__', '(unknown version)'),
+                builtins_path, env_lines))
+            report('NVRTC Test', _nvrtc_test(
+                cupy, key, use_cache=not args.no_cache))
+        else:
+            report('NVRTC Test', 'Skipped (use --compile-test to run)')
 
     ### Python Modules
     header('Python Modules')
-    def _report_pypkg(name, modname, pkg):
-        import_msg = None
-        try:
-            mod = __import__(modname)
-            version = '(unknown version)'
-            if hasattr(mod, '__version__'):
-                version = mod.__version__
-            import_msg = 'importing {} from {}'.format(version, mod.__path__)
-        except Exception as e:
-            import_msg = 'import failed with {}: {}'.format(
-                type(e).__name__, str(e))
-
-        install_msg = 'not installed'
-        if pkg is not None:
-            install_msg = 'OK ({} version {} from {})'.format(
-                pkg.project_name, pkg.version, pkg.location)
-        status = '{} ({})'.format(install_msg, import_msg)
-
-        report(name, status)
-
     # Chainer
-    _report_pypkg('Chainer', 'chainer', get_package('chainer'))
+    _report_pypkg('Chainer', imports['chainer'], get_package('chainer'))
 
     # CuPy
-    cupy_pkgs = [
-        ('cupy',        lambda v: 7000 <= v < 10000),
-        ('cupy-cuda80', lambda v: 8000 <= v <  9000),
-        ('cupy-cuda90', lambda v: 9000 <= v <  9010),
-        ('cupy-cuda91', lambda v: 9010 <= v <  9020),
-        ('cupy-cuda92', lambda v: 9020 <= v <  9030),
-    ]
     cupy_found = None
-    for (pkgname, is_cuda_version_supported) in cupy_pkgs:
+    for (pkgname, (lo, hi)) in CUPY_CUDA_RANGES.items():
         pkg = get_package(pkgname)
         if pkg is not None:
-            _report_pypkg('CuPy', 'cupy', pkg)
+            _report_pypkg('CuPy', imports['cupy'], pkg)
             if (cudart_version is not None and
-                    not is_cuda_version_supported(cudart_version)):
-                print('*** ERROR: This CuPy package ({}) does not support '
-                      'CUDA version {}!'.format(pkgname, cudart_version))
+                    not lo <= cudart_version < hi):
+                output('*** ERROR: This CuPy package ({}) does not support '
+                       'CUDA version {}!'.format(pkgname, cudart_version))
             if cupy_found is not None:
-                print('*** ERROR: multiple CuPy packages are installed! '
-                      'You can only install one of {}.'''.format(
-                          [x[0] for x in cupy_pkgs]))
+                output('*** ERROR: multiple CuPy packages are installed! '
+                       'You can only install one of {}.'''.format(
+                           list(CUPY_CUDA_RANGES)))
             cupy_found = pkg
     if cupy_found is None:
-        _report_pypkg('CuPy', 'cupy', None)
+        _report_pypkg('CuPy', imports['cupy'], None)
 
     # NumPy
-    _report_pypkg('NumPy', 'numpy', get_package('numpy'))
+    _report_pypkg('NumPy', imports['numpy'], get_package('numpy'))
 
     # iDeep
-    _report_pypkg('iDeep', 'ideep4py', get_package('ideep4py'))
+    _report_pypkg('iDeep', imports['ideep4py'], get_package('ideep4py'))
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Validate Chainer/CuPy installation.')
+    parser.add_argument(
+        '--compile-test', action='store_true',
+        help='test compiling a kernel with NVRTC (may take seconds)')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='run --compile-test ignoring the cached result')
+    args = parser.parse_args(argv)
+    if args.no_cache:
+        args.compile_test = True
+
+    # Start importing Python modules in background so that heavy imports
+    # overlap with each other and with the checks below.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    imports = {}
+    for modname in ('chainer', 'cupy', 'numpy', 'ideep4py'):
+        imports[modname] = executor.submit(__import__, modname)
+
+    try:
+        check(args, imports)
+    except BaseException:
+        # Do not wait for background imports on errors or Ctrl-C.
+        executor.shutdown(wait=False)
+        raise
+    else:
+        executor.shutdown()
+    finally:
+        # Write the report collected so far even on errors or Ctrl-C.
+        flush_output()
+
 
 if __name__ == '__main__':
     main()